@@ -1,113 +1,279 @@
-from flask import Flask, render_template, request
+from flask import Flask, jsonify, render_template, request, url_for
+from concurrent.futures import ThreadPoolExecutor
+import json
 import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+from functools import lru_cache
 
+import db
 import scrape_logger
 import scraper
 import normalizer
 import worth_it_score
 from market_analysis import MarketAnalyzer
+from link_generator import districts
 
 app = Flask(__name__)
 
-districts = {
-    f"budapest{str(i).zfill(2)}": f"Budapest {roman} kerület"
-    for i, roman in zip(range(1, 24), [
-        "I.", "II.", "III.", "IV.", "V.", "VI.", "VII.", "VIII.", "IX.",
-        "X.", "XI.", "XII.", "XIII.", "XIV.", "XV.", "XVI.", "XVII.", "XVIII.",
-        "XIX.", "XX.", "XXI.", "XXII.", "XXIII."
-    ])
+# Scrape pipelines run off the request threads. A single worker: every pipeline
+# rewrites the same SQLite file, so concurrent runs would only contend on its lock.
+pipeline_executor = ThreadPoolExecutor(max_workers=1)
+pipeline_tasks = {}  # task id -> Future, until reported finished or evicted
+running_pipelines = {}  # search filters -> Future of its queued or running pipeline
+pipeline_finished_at = {}  # finished Future -> time.monotonic() it finished at
+pipeline_lock = threading.Lock()
+# How long a finished task's status waits for its loading page to poll it
+FINISHED_TASK_TTL = 15 * 60  # seconds
+
+# Composite indexes for query_db: the Jelleg equality filter leads, the sort column trails
+LISTING_INDEXES = {
+    "idx_jelleg_price": 'Jelleg, price_huf_clean',
+    "idx_jelleg_size": 'Jelleg, Méret_clean',
+    "idx_jelleg_worth": 'Jelleg, "Ár-Érték Index"',
+    "idx_jelleg_diff": 'Jelleg, "Ár/m² Eltérés %"',
+    "idx_district": 'district_code',
 }
 
-def query_db(filters):
-    con = sqlite3.connect("real_estate_listings.db")
-    con.row_factory = sqlite3.Row  # So we can use column names
-    cur = con.cursor()
+def ensure_district_codes(con):
+    """Add and backfill district_code on databases the normalizer hasn't migrated yet"""
+    columns = [row[1] for row in con.execute("PRAGMA table_info(listings)")]
+    if not columns or "district_code" in columns:
+        return
 
-    query = "SELECT * FROM listings WHERE 1=1"
-    params = []
+    # The shared connection is autocommit: never leave it inside a failed transaction
+    con.execute("BEGIN")
+    try:
+        con.execute("ALTER TABLE listings ADD COLUMN district_code TEXT")
+        con.executemany(
+            "UPDATE listings SET district_code = ? WHERE rowid = ?",
+            [(normalizer.district_code(location), rowid)
+             for rowid, location in con.execute("SELECT rowid, location FROM listings").fetchall()]
+        )
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
 
-    # Filter logic
-    if filters.get("type"):
-        query += " AND Jelleg = ?"
-        if filters["type"] == "haz":
-            params.append("ház")
-        elif filters["type"] == "lakas":
-            params.append("lakás")
-        else:
-            params.append(filters["type"])
+def ensure_indexes():
+    con = db.get_connection("real_estate_listings.db")
+    with db.write_lock:
+        ensure_district_codes(con)
+        for name, columns in LISTING_INDEXES.items():
+            try:
+                con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON listings({columns})")
+            except sqlite3.OperationalError:
+                # Table or cleaned columns don't exist yet - created after the next scrape
+                pass
 
-    if filters.get("location"):
-        query += " AND location LIKE ?"
-        params.append(f"%{districts[filters['location']]}%")
+def district_filter(location):
+    # Unknown district codes (malformed query params) skip the filter
+    if location not in districts:
+        raise ValueError(f"Unknown district: {location}")
+    return location
 
-    if filters.get("min_price"):
-        try:
-            query += " AND price_huf_clean >= ?"
-            params.append(float(filters["min_price"]))
-        except (ValueError, TypeError):
-            pass
+# (query param, WHERE fragment, converter) for each query_db filter
+FILTERS = [
+    ("type", " AND Jelleg = ?", lambda v: {"haz": "ház", "lakas": "lakás"}.get(v, v)),
+    ("location", " AND district_code = ?", district_filter),
+    ("min_price", " AND price_huf_clean >= ?", float),
+    ("max_price", " AND price_huf_clean <= ?", float),
+    ("min_size", " AND Méret_clean >= ?", float),
+    ("max_size", " AND Méret_clean <= ?", float),
+    ("min_rooms", " AND rooms_clean >= ?", float),
+    ("max_rooms", " AND rooms_clean <= ?", float),
+]
 
-    if filters.get("max_price"):
-        try:
-            query += " AND price_huf_clean <= ?"
-            params.append(float(filters["max_price"]))
-        except (ValueError, TypeError):
-            pass
+# Sort option -> (column, direction); every sort is tie-broken on rowid for keyset paging
+SORTS = {
+    "price_asc": ("price_huf_clean", "ASC"),
+    "price_desc": ("price_huf_clean", "DESC"),
+    "size_asc": ("Méret_clean", "ASC"),
+    "size_desc": ("Méret_clean", "DESC"),
+    "worth_it_asc": ("Ár-Érték Index", "ASC"),
+    "worth_it_desc": ("Ár-Érték Index", "DESC"),
+    "value_assessment_asc": ("Érték Minősítés", "ASC"),
+    "value_assessment_desc": ("Érték Minősítés", "DESC"),
+    "price_diff_asc": ("Ár/m² Eltérés %", "ASC"),
+    "price_diff_desc": ("Ár/m² Eltérés %", "DESC"),
+}
 
-    if filters.get("min_size"):
-        try:
-            query += " AND Méret_clean >= ?"
-            params.append(float(filters["min_size"]))
-        except (ValueError, TypeError):
-            pass
+PAGE_SIZE = 50
 
-    if filters.get("max_size"):
-        try:
-            query += " AND Méret_clean <= ?"
-            params.append(float(filters["max_size"]))
-        except (ValueError, TypeError):
-            pass
+def keyset_condition(column, direction, after_null):
+    """
+    WHERE fragment selecting the rows after the cursor row in
+    ORDER BY column direction, rowid direction. The row-value comparison lets
+    SQLite seek the (Jelleg, column) index instead of rescanning the range.
+    SQLite sorts NULLs first ascending and last descending, so NULL keys need
+    their own branches; descending, the NULL rows after a value cursor come
+    from a separate "nulls" query (see query_db) so the seek stays a range.
+    Binds (rowid) when after_null, otherwise (value, rowid).
+    """
+    if direction == "ASC":
+        if after_null:
+            return f'("{column}" IS NOT NULL OR ("{column}" IS NULL AND rowid > ?))'
+        return f'(("{column}", rowid) > (?, ?))'
+
+    if after_null:
+        return f'("{column}" IS NULL AND rowid < ?)'
+    return f'(("{column}", rowid) < (?, ?))'
+
+@lru_cache(maxsize=256)
+def listing_query(active_filters, sort, keyset):
+    """
+    SQL text for one query shape, so repeated shapes reuse the same string
+    (and SQLite's prepared statement). active_filters is a tuple of FILTERS
+    indexes; keyset is None (first page), "value" or "null" (cursor key),
+    or "nulls" for every NULL-keyed row.
+    """
+    query = "SELECT rowid, * FROM listings WHERE 1=1"
+    query += "".join(FILTERS[i][1] for i in active_filters)
+
+    # Resume after the last row of the previous page
+    sort_column, direction = SORTS.get(sort, (None, "ASC"))
+    if keyset == "nulls":
+        query += f' AND "{sort_column}" IS NULL'
+    elif keyset and sort_column:
+        query += f" AND {keyset_condition(sort_column, direction, keyset == 'null')}"
+    elif keyset:
+        query += " AND rowid > ?"
+
+    # Sorting logic
+    if sort_column:
+        query += f' ORDER BY "{sort_column}" {direction}, rowid {direction}'
+    else:
+        query += " ORDER BY rowid"
+
+    # Fetch one extra row to know whether there is a next page
+    return query + " LIMIT ?"
+
+def query_db(filters, page_size=PAGE_SIZE, cursor=None):
+    """
+    Return one page of matching listings and the cursor of the next page
+    (None on the last page). Pages are keyset-paginated on the sort column.
+    """
+    con = db.get_connection("real_estate_listings.db")
+    cur = con.cursor()
+    cur.row_factory = sqlite3.Row  # So we can use column names
 
-    if filters.get("min_rooms"):
+    active_filters = []
+    params = []
+
+    # Filter logic - invalid values skip their filter
+    for i, (key, _, convert) in enumerate(FILTERS):
+        if not filters.get(key):
+            continue
         try:
-            query += " AND rooms_clean >= ?"
-            params.append(float(filters["min_rooms"]))
+            value = convert(filters[key])
         except (ValueError, TypeError):
-            pass
+            continue
+        active_filters.append(i)
+        params.append(value)
+
+    sort = filters.get("sort") if filters.get("sort") in SORTS else None
+    sort_column, direction = SORTS[sort] if sort else (None, "ASC")
+    filter_params = list(params)
 
-    if filters.get("max_rooms"):
+    keyset = None
+    if cursor:
         try:
-            query += " AND rooms_clean <= ?"
-            params.append(float(filters["max_rooms"]))
+            last_value, last_rowid = json.loads(cursor)
         except (ValueError, TypeError):
-            pass
+            last_value, last_rowid = None, None
+        # Tampered cursors (nested values, non-integer rowids) are ignored like malformed ones
+        if type(last_rowid) is not int or not isinstance(last_value, (str, int, float, type(None))):
+            last_rowid = None
+        if last_rowid is not None:
+            if sort_column and last_value is not None:
+                keyset = "value"
+                params.extend([last_value, last_rowid])
+            else:
+                keyset = "null"
+                params.append(last_rowid)
 
-    # Sorting logic
-    sort = filters.get("sort")
-    if sort == "price_asc":
-        query += " ORDER BY price_huf_clean ASC"
-    elif sort == "price_desc":
-        query += " ORDER BY price_huf_clean DESC"
-    elif sort == "size_asc":
-        query += " ORDER BY Méret_clean ASC"
-    elif sort == "size_desc":
-        query += " ORDER BY Méret_clean DESC"
-    elif sort == "worth_it_asc":
-        query += ' ORDER BY "Ár-Érték Index" ASC'
-    elif sort == "worth_it_desc":
-        query += ' ORDER BY "Ár-Érték Index" DESC'
-    elif sort == "value_assessment_asc":
-        query += ' ORDER BY "Érték Minősítés" ASC'
-    elif sort == "value_assessment_desc":
-        query += ' ORDER BY "Érték Minősítés" DESC'
-    elif sort == "price_diff_asc":
-        query += ' ORDER BY "Ár/m² Eltérés %" ASC'
-    elif sort == "price_diff_desc":
-        query += ' ORDER BY "Ár/m² Eltérés %" DESC'
+    query = listing_query(tuple(active_filters), sort, keyset)
+    params.append(page_size + 1)
 
     rows = cur.execute(query, params).fetchall()
-    con.close()
-    return rows
+
+    # Descending, NULL keys sort after every value but the value seek skips them
+    if keyset == "value" and direction == "DESC" and len(rows) <= page_size:
+        nulls_query = listing_query(tuple(active_filters), sort, "nulls")
+        rows += cur.execute(nulls_query, filter_params + [page_size + 1 - len(rows)]).fetchall()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = json.dumps([last[sort_column] if sort_column else None, last["rowid"]])
+    return rows, next_cursor
+
+
+def run_scrape_pipeline(filters):
+    """Scrape, normalize and score listings for a search - runs on the pipeline executor"""
+    print("[SCRAPING] New data required, starting scrape...")
+    
+    # Use intelligent interval detection for size parameters
+    analyzer = MarketAnalyzer()
+    original_min_size = filters.get("min_size")
+    original_max_size = filters.get("max_size")
+    
+    if original_min_size or original_max_size:
+        expanded_min, expanded_max = analyzer.get_required_intervals_for_search(
+            original_min_size, original_max_size
+        )
+        print(f"[INTERVALS] Original size range: {original_min_size}-{original_max_size}")
+        print(f"[INTERVALS] Expanded to cover market intervals: {expanded_min}-{expanded_max}")
+        
+        # Use expanded range for scraping to get complete market data
+        scraper.main(filters["type"], filters["min_price"], filters["max_price"], 
+                     filters["location"], expanded_min, expanded_max, 
+                     filters["min_rooms"], filters["max_rooms"])
+    else:
+        # No size filters, scrape as normal
+        scraper.main(filters["type"], filters["min_price"], filters["max_price"], 
+                     filters["location"], filters["min_size"], filters["max_size"], 
+                     filters["min_rooms"], filters["max_rooms"])
+    
+    normalizer.main()
+    worth_it_score.main()
+    ensure_indexes()
+
+
+def start_pipeline(backend_filters, filters):
+    """
+    Future of the pipeline for a search, reusing one already queued or running
+    for the same filters - the search isn't logged until its scrape finishes
+    """
+    key = tuple(sorted(backend_filters.items()))
+    with pipeline_lock:
+        future = running_pipelines.get(key)
+        if future is not None:
+            return future
+        future = pipeline_executor.submit(run_scrape_pipeline, filters)
+        running_pipelines[key] = future
+    # Outside the lock: an already finished future runs the callback right here
+    future.add_done_callback(lambda done: finish_pipeline(key, done))
+    return future
+
+def finish_pipeline(key, future):
+    now = time.monotonic()
+    with pipeline_lock:
+        if running_pipelines.get(key) is future:
+            del running_pipelines[key]
+        pipeline_finished_at[future] = now
+
+        # Evict the tasks of loading pages that were closed before their pipeline finished
+        expired = {done for done, finished_at in pipeline_finished_at.items()
+                   if now - finished_at > FINISHED_TASK_TTL}
+        for done in expired:
+            del pipeline_finished_at[done]
+        for task_id, task_future in list(pipeline_tasks.items()):
+            if task_future in expired:
+                pipeline_tasks.pop(task_id, None)
 
 
 @app.route("/", methods=["GET"])
@@ -166,38 +332,36 @@ def results():
         should_scrape_new, compatible_filters = scrape_logger.should_scrape(filters=backend_filters)
         
         if should_scrape_new:
-            print("[SCRAPING] New data required, starting scrape...")
-            
-            # Use intelligent interval detection for size parameters
-            analyzer = MarketAnalyzer()
-            original_min_size = filters.get("min_size")
-            original_max_size = filters.get("max_size")
-            
-            if original_min_size or original_max_size:
-                expanded_min, expanded_max = analyzer.get_required_intervals_for_search(
-                    original_min_size, original_max_size
-                )
-                print(f"[INTERVALS] Original size range: {original_min_size}-{original_max_size}")
-                print(f"[INTERVALS] Expanded to cover market intervals: {expanded_min}-{expanded_max}")
-                
-                # Use expanded range for scraping to get complete market data
-                scraper.main(filters["type"], filters["min_price"], filters["max_price"], 
-                           filters["location"], expanded_min, expanded_max, 
-                           filters["min_rooms"], filters["max_rooms"])
-            else:
-                # No size filters, scrape as normal
-                scraper.main(filters["type"], filters["min_price"], filters["max_price"], 
-                           filters["location"], filters["min_size"], filters["max_size"], 
-                           filters["min_rooms"], filters["max_rooms"])
-            
-            normalizer.main()
-            worth_it_score.main()
+            # Run the pipeline in the background; the loading page polls until it finishes
+            task_id = uuid.uuid4().hex
+            pipeline_tasks[task_id] = start_pipeline(backend_filters, filters)
+            query = urlencode({k: v for k, v in filters.items() if v})
+            return render_template("loading.html", query=query, task_id=task_id)
         else:
             print(f"[CACHE] Using existing data from compatible search: {compatible_filters}")
 
     filters = {k: v for k, v in filters.items() if v}
-    ads = query_db(filters)
-    return render_template("results.html", ads=ads)
+    ads, next_cursor = query_db(filters, cursor=request.args.get("cursor"))
+    next_page_url = url_for("results", **filters, cursor=next_cursor) if next_cursor else None
+    first_page_url = url_for("results", **filters) if request.args.get("cursor") else None
+    return render_template("results.html", ads=ads, next_page_url=next_page_url,
+                           first_page_url=first_page_url)
+
+@app.route("/task_status/<task_id>")
+def task_status(task_id):
+    future = pipeline_tasks.get(task_id)
+    if future is None:
+        return jsonify({"state": "unknown"}), 404
+
+    if not future.done():
+        return jsonify({"state": "running" if future.running() else "pending"})
+    # Each loading page has its own task id, so the entry can go once it has been told
+    pipeline_tasks.pop(task_id, None)
+    if future.exception() is not None:
+        return jsonify({"state": "failed", "error": str(future.exception())})
+    return jsonify({"state": "done"})
+
+ensure_indexes()
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,39 @@
+import sqlite3
+import threading
+
+# One long-lived connection per database file, shared by every thread
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Per-connection prepared statement cache; query shapes are few but varied
+CACHED_STATEMENTS = 256
+
+# Serializes writes made through the shared connections
+write_lock = threading.Lock()
+
+
+def configure(conn):
+    """Apply the WAL / relaxed-sync / cache pragmas used for the project databases"""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")  # ~64 MB page cache
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MB memory-mapped I/O
+    return conn
+
+
+def get_connection(db_path):
+    """
+    Return the shared connection for db_path, opening it on first use.
+
+    The connection runs in autocommit mode and may be used from any thread;
+    callers that write should hold write_lock.
+    """
+    with _connections_lock:
+        conn = _connections.get(db_path)
+        if conn is None:
+            conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None,
+                                   cached_statements=CACHED_STATEMENTS)
+            configure(conn)
+            _connections[db_path] = conn
+        return conn
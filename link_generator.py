@@ -1,3 +1,13 @@
+# oc.hu "elhelyezkedes" codes for the Budapest districts and their display names
+districts = {
+    f"budapest{str(i).zfill(2)}": f"Budapest {roman} kerület"
+    for i, roman in zip(range(1, 24), [
+        "I.", "II.", "III.", "IV.", "V.", "VI.", "VII.", "VIII.", "IX.",
+        "X.", "XI.", "XII.", "XIII.", "XIV.", "XV.", "XVI.", "XVII.", "XVIII.",
+        "XIX.", "XX.", "XXI.", "XXII.", "XXIII."
+    ])
+}
+
 def generate_oc_link(
     jelleg="lakas",
     ertekesites="elado",
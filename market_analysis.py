@@ -1,7 +1,27 @@
-import sqlite3
+from array import array
+import bisect
 import json
 from datetime import datetime
+import math
 import statistics
+from functools import lru_cache
+
+import db
+
+
+class _Median:
+    """SQLite aggregate returning the median of its inputs."""
+    
+    def __init__(self):
+        self.values = array('d')  # Packed doubles rather than a list of float objects
+    
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+    
+    def finalize(self):
+        return statistics.median(self.values) if self.values else None
+
 
 class MarketAnalyzer:
     """
@@ -23,6 +43,27 @@ class MarketAnalyzer:
         (501, float('inf'))
     ]
     
+    # Upper bounds of SIZE_INTERVALS, for bisecting a size to its interval
+    _UPPER_BOUNDS = [max_size for _, max_size in SIZE_INTERVALS]
+    
+    # SQL expression mapping Méret_clean to its index in SIZE_INTERVALS (NULL if in a gap)
+    SIZE_BIN_SQL = "CASE " + " ".join(
+        f"WHEN Méret_clean >= {min_size} THEN {i}" if max_size == float('inf')
+        else f"WHEN Méret_clean BETWEEN {min_size} AND {max_size} THEN {i}"
+        for i, (min_size, max_size) in enumerate(SIZE_INTERVALS)
+    ) + " END"
+    
+    # Listings with enough data to be part of a market segment
+    COMPLETE_LISTING_SQL = """
+        lokáció IS NOT NULL 
+        AND Jelleg IS NOT NULL 
+        AND Állapot IS NOT NULL 
+        AND Méret_clean IS NOT NULL 
+        AND price_huf_clean IS NOT NULL
+        AND Méret_clean > 0
+        AND price_huf_clean > 0
+    """
+    
     def __init__(self, db_path="real_estate_listings.db"):
         self.db_path = db_path
     
@@ -31,10 +72,10 @@ class MarketAnalyzer:
         if not size:
             return None
         
-        for min_size, max_size in self.SIZE_INTERVALS:
-            if min_size <= size <= max_size:
-                return (min_size, max_size)
-        return None
+        i = bisect.bisect_left(self._UPPER_BOUNDS, size)
+        if i < len(self.SIZE_INTERVALS) and self.SIZE_INTERVALS[i][0] <= size:
+            return self.SIZE_INTERVALS[i]
+        return None  # Negative or in a gap between intervals (e.g. 30.5)
     
     def get_required_intervals_for_search(self, min_size, max_size):
         """
@@ -66,78 +107,143 @@ class MarketAnalyzer:
             
         return expanded_min, expanded_max
     
-    def calculate_market_stats(self):
+    def get_listings_version(self):
+        """
+        Cheap freshness token for the listings table. data_version changes whenever
+        another connection (scraper, normalizer) commits, so in-place updates count too.
+        """
+        conn = db.get_connection(self.db_path)
+        count, max_rowid = conn.execute("SELECT COUNT(*), MAX(rowid) FROM listings").fetchone()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return count, max_rowid, data_version
+    
+    def calculate_market_stats(self, listings_version=None):
         """
         Calculate market statistics for all location/type/condition/size combinations.
-        Returns a dictionary with market data.
+        Returns a dictionary with market data, cached until the listings change.
+        Callers looking up many listings should take get_listings_version() once
+        and pass it in, so the table is not re-counted on every lookup.
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if listings_version is None:
+            listings_version = self.get_listings_version()
+        return self._calculate_market_stats(listings_version)
+    
+    @lru_cache(maxsize=1)
+    def _calculate_market_stats(self, listings_version):
+        conn = db.get_connection(self.db_path)
+        conn.create_aggregate("median", 1, _Median)
         
-        # Get all properties with complete data
-        cursor.execute("""
-            SELECT lokáció, Jelleg, Állapot, Méret_clean, price_huf_clean 
-            FROM listings 
-            WHERE lokáció IS NOT NULL 
-                AND Jelleg IS NOT NULL 
-                AND Állapot IS NOT NULL 
-                AND Méret_clean IS NOT NULL 
-                AND price_huf_clean IS NOT NULL
-                AND Méret_clean > 0
-                AND price_huf_clean > 0
+        # Aggregate each market segment inside SQLite; only segment rows come back.
+        # Segments are ordered by first appearance so fallback matching sees them
+        # in the same order as the listings table.
+        cursor = conn.execute(f"""
+            SELECT lokáció, Jelleg, Állapot, size_bin,
+                COUNT(*), AVG(ppsm), SUM(ppsm * ppsm), median(ppsm), MIN(ppsm), MAX(ppsm)
+            FROM (
+                SELECT rowid, lokáció, Jelleg, Állapot,
+                    price_huf_clean / Méret_clean AS ppsm,
+                    {self.SIZE_BIN_SQL} AS size_bin
+                FROM listings 
+                WHERE {self.COMPLETE_LISTING_SQL}
+            )
+            WHERE size_bin IS NOT NULL
+            GROUP BY lokáció, Jelleg, Állapot, size_bin
+            HAVING COUNT(*) >= 2  -- Need at least 2 properties for meaningful stats
+            ORDER BY MIN(rowid)
         """)
         
-        properties = cursor.fetchall()
-        conn.close()
-        
-        # Group properties by market segments
-        market_segments = {}
-        
-        for lokacio, jelleg, allapot, meret, price in properties:
-            # Calculate price per m²
-            price_per_sqm = price / meret
-            
-            # Get size interval
-            size_interval = self.get_size_interval(meret)
-            if not size_interval:
-                continue
-            
-            # Create market segment key
-            segment_key = (lokacio, jelleg, allapot, size_interval)
-            
-            if segment_key not in market_segments:
-                market_segments[segment_key] = []
-            
-            market_segments[segment_key].append({
-                'meret': meret,
-                'price': price,
-                'price_per_sqm': price_per_sqm
-            })
-        
-        # Calculate statistics for each segment
         market_stats = {}
-        for segment_key, properties in market_segments.items():
-            if len(properties) < 2:  # Need at least 2 properties for meaningful stats
-                continue
-                
-            prices_per_sqm = [p['price_per_sqm'] for p in properties]
+        for lokacio, jelleg, allapot, size_bin, count, avg, sum_sq, median, min_ppsm, max_ppsm in cursor:
+            segment_key = (lokacio, jelleg, allapot, self.SIZE_INTERVALS[size_bin])
             
             market_stats[segment_key] = {
-                'count': len(properties),
-                'avg_price_per_sqm': statistics.mean(prices_per_sqm),
-                'median_price_per_sqm': statistics.median(prices_per_sqm),
-                'min_price_per_sqm': min(prices_per_sqm),
-                'max_price_per_sqm': max(prices_per_sqm),
-                'std_price_per_sqm': statistics.stdev(prices_per_sqm) if len(prices_per_sqm) > 1 else 0,
-                'properties': properties
+                'count': count,
+                'avg_price_per_sqm': avg,
+                'median_price_per_sqm': median,
+                'min_price_per_sqm': min_ppsm,
+                'max_price_per_sqm': max_ppsm,
+                'std_price_per_sqm': self.sample_std(count, avg, sum_sq)
             }
         
         return market_stats
     
-    def get_property_market_insight(self, lokacio, jelleg, allapot, meret, price):
+    def find_fallback_match(self, lokacio, jelleg, allapot, size_interval, listings_version=None):
+        """
+        First segment (in market stats order) of the same size interval that has
+        the same location and type, or the same type and condition in the same
+        district. Returns (comparison_type, segment data) or None.
+        """
+        if listings_version is None:
+            listings_version = self.get_listings_version()
+        by_location, by_district = self._fallback_index(listings_version)
+        district = lokacio.split(',')[0]
+        candidates = [match for match in (by_location.get((lokacio, jelleg, size_interval)),
+                                          by_district.get((jelleg, allapot, size_interval, district)))
+                      if match]
+        if not candidates:
+            return None
+        
+        _, key_lokacio, data = min(candidates, key=lambda match: match[0])
+        comparison_type = 'same_location_type' if key_lokacio == lokacio else 'same_district_type'
+        return comparison_type, data
+    
+    @lru_cache(maxsize=1)
+    def _fallback_index(self, listings_version):
+        # First segment per fallback key, with its position, so each lookup is a dict hit
+        # instead of a scan over all segments
+        by_location, by_district = {}, {}
+        for position, (key, data) in enumerate(self._calculate_market_stats(listings_version).items()):
+            key_lokacio, key_jelleg, key_allapot, key_interval = key
+            match = (position, key_lokacio, data)
+            by_location.setdefault((key_lokacio, key_jelleg, key_interval), match)
+            by_district.setdefault((key_jelleg, key_allapot, key_interval, key_lokacio.split(',')[0]), match)
+        return by_location, by_district
+    
+    @staticmethod
+    def sample_std(count, avg, sum_sq):
+        """Sample standard deviation from a segment's count, mean and sum of squares."""
+        variance = max(sum_sq - count * avg * avg, 0) / (count - 1)
+        return math.sqrt(variance)
+    
+    def get_listings_with_segment_stats(self):
+        """
+        Fetch every listing together with the stats of its exact market segment,
+        computed by SQLite window functions in the same pass. Yields
+        (url, lokacio, jelleg, allapot, meret, price, rooms, market_data) where
+        market_data is None when the segment has fewer than 2 properties.
+        """
+        conn = db.get_connection(self.db_path)
+        cursor = conn.execute(f"""
+            SELECT url, lokáció, Jelleg, Állapot, Méret_clean, price_huf_clean, rooms_clean,
+                COUNT(ppsm) OVER segment, AVG(ppsm) OVER segment, SUM(ppsm * ppsm) OVER segment
+            FROM (
+                SELECT url, lokáció, Jelleg, Állapot, Méret_clean, price_huf_clean, rooms_clean,
+                    {self.SIZE_BIN_SQL} AS size_bin,
+                    CASE WHEN {self.COMPLETE_LISTING_SQL} AND ({self.SIZE_BIN_SQL}) IS NOT NULL
+                        THEN price_huf_clean / Méret_clean END AS ppsm
+                FROM listings
+            )
+            WINDOW segment AS (PARTITION BY lokáció, Jelleg, Állapot, size_bin)
+        """)
+        
+        for *listing, count, avg, sum_sq in cursor:
+            market_data = None
+            if count >= 2:  # Same threshold as calculate_market_stats
+                market_data = {
+                    'count': count,
+                    'avg_price_per_sqm': avg,
+                    'std_price_per_sqm': self.sample_std(count, avg, sum_sq)
+                }
+            yield (*listing, market_data)
+    
+    def get_property_market_insight(self, lokacio, jelleg, allapot, meret, price, market_data=None,
+                                    listings_version=None):
         """
         Get market insight for a specific property.
         Returns comparison with market average and other insights.
+        market_data can carry the property's exact segment stats when the caller
+        already has them (see get_listings_with_segment_stats); listings_version
+        is passed through to calculate_market_stats and find_fallback_match.
         """
         if not all([lokacio, jelleg, allapot, meret, price]) or meret <= 0 or price <= 0:
             return None
@@ -146,27 +252,18 @@ class MarketAnalyzer:
         if not size_interval:
             return None
         
-        market_stats = self.calculate_market_stats()
         segment_key = (lokacio, jelleg, allapot, size_interval)
         
         property_price_per_sqm = price / meret
         
         # Try to find exact match first
-        market_data = market_stats.get(segment_key)
+        if market_data is None:
+            market_data = self.calculate_market_stats(listings_version).get(segment_key)
         
         # If no exact match, try broader matches
-        fallback_matches = []
+        fallback_match = None
         if not market_data:
-            for key, data in market_stats.items():
-                key_lokacio, key_jelleg, key_allapot, key_interval = key
-                
-                # Same location and type, any condition
-                if lokacio == key_lokacio and jelleg == key_jelleg and size_interval == key_interval:
-                    fallback_matches.append(('same_location_type', data))
-                # Same type and condition, any location in same district
-                elif (jelleg == key_jelleg and allapot == key_allapot and size_interval == key_interval 
-                      and lokacio.split(',')[0] == key_lokacio.split(',')[0]):
-                    fallback_matches.append(('same_district_type', data))
+            fallback_match = self.find_fallback_match(lokacio, jelleg, allapot, size_interval, listings_version)
         
         # Use the best available match
         comparison_type = 'exact'
@@ -174,9 +271,8 @@ class MarketAnalyzer:
             market_avg = market_data['avg_price_per_sqm']
             market_count = market_data['count']
             market_std = market_data['std_price_per_sqm']
-        elif fallback_matches:
-            # Use the first fallback match
-            comparison_type, market_data = fallback_matches[0]
+        elif fallback_match:
+            comparison_type, market_data = fallback_match
             market_avg = market_data['avg_price_per_sqm']
             market_count = market_data['count']
             market_std = market_data['std_price_per_sqm']
@@ -211,12 +307,16 @@ class MarketAnalyzer:
             'size_interval': size_interval
         }
     
-    def calculate_enhanced_worth_it_score(self, lokacio, jelleg, allapot, meret, price, rooms):
+    def calculate_enhanced_worth_it_score(self, lokacio, jelleg, allapot, meret, price, rooms, market_data=None,
+                                          insight=None, listings_version=None):
         """
         Calculate an enhanced worth it score based on market analysis.
         Returns a score between 0-100 where higher is better value.
+        insight can be passed when the caller already has it from get_property_market_insight.
         """
-        insight = self.get_property_market_insight(lokacio, jelleg, allapot, meret, price)
+        if insight is None:
+            insight = self.get_property_market_insight(lokacio, jelleg, allapot, meret, price, market_data,
+                                                       listings_version)
         
         if not insight:
             # Fallback to simple calculation if no market data
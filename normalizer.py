@@ -1,56 +1,78 @@
 import sqlite3
 import re
+from functools import lru_cache
 
+import db
+from link_generator import districts
 
+# Compiled once at import - these run several times per row during normalization
+_NONDIGIT_RE = re.compile(r"[^\d,\.]")
+_M_SUFFIX_RE = re.compile(r"([\d.,]+)M")
+_TO_NUMBER_TRANS = str.maketrans({" ": None, "\xa0": None, ",": "."})
+# Drops spaces and the "Ft" / "HUF" / "€" currency markers and turns decimal commas into dots
+_PRICE_TRANS = str.maketrans({"\xa0": None, " ": None, "F": None, "t": None, "H": None, "U": None,
+                              "€": None, ",": "."})
+_DISTRICT_RE = re.compile(r"Budapest [IVX]+\. kerület")
+
+# "Budapest XI. kerület" -> "budapest11", the same code the search form submits
+DISTRICT_CODES = {name: code for code, name in districts.items()}
+
+
+# Raw attribute strings repeat heavily across listings ("106m²", "3 szoba", ...),
+# so each distinct value is parsed once and reused for every row that shares it.
+@lru_cache(maxsize=4096)
 def to_number(value):
     if not value:
         return None
 
     # Remove all non-digit characters except comma and dot
-    value = re.sub(r"[^\d,\.]", "", str(value))
+    value = _NONDIGIT_RE.sub("", str(value))
 
     # Handle comma as decimal separator (Hungarian/European style)
     if value.count(",") == 1 and value.count(".") == 0:
         value = value.replace(",", ".")
 
     # Remove any thousands separators (either space, dot, or comma used wrongly)
-    value = value.replace(" ", "").replace("\xa0", "").replace(",", ".")
+    value = value.translate(_TO_NUMBER_TRANS)
 
     try:
         return float(value)
     except ValueError:
         return None
+
+
+@lru_cache(maxsize=4096)
 def parse_price(price_str):
     if not price_str:
         return None
 
-    # Remove non-breaking spaces, regular spaces, currency symbols
-    cleaned = (
-        str(price_str)
-        .replace("\xa0", "")
-        .replace(" ", "")
-        .replace("Ft", "")
-        .replace("HUF", "")
-        .replace("€", "")
-    )
+    # Remove non-breaking spaces, regular spaces, currency symbols in a single pass
+    cleaned = str(price_str).translate(_PRICE_TRANS)
 
     # Match M-suffix prices like '1.5M', '275M'
-    match = re.match(r"([\d.,]+)M", cleaned)
+    match = _M_SUFFIX_RE.match(cleaned)
     if match:
-        number = match.group(1).replace(",", ".")
         try:
-            return float(number) * 1_000_000
+            return float(match.group(1)) * 1_000_000
         except ValueError:
             return None
 
     # Otherwise, assume it's a raw number like 199000000 or '264,9'
     try:
-        return float(cleaned.replace(",", "."))
+        return float(cleaned)
     except ValueError:
         return None
 
+@lru_cache(maxsize=256)
+def district_code(location):
+    if not location:
+        return None
+
+    match = _DISTRICT_RE.search(location)
+    return DISTRICT_CODES.get(match.group()) if match else None
+
 def main():
-    conn = sqlite3.connect("real_estate_listings.db")
+    conn = db.configure(sqlite3.connect("real_estate_listings.db"))
     cursor = conn.cursor()
 
     # Add new columns if not already there
@@ -68,42 +90,53 @@ def main():
         if col_name not in columns:
             cursor.execute(f"ALTER TABLE listings ADD COLUMN '{col_name}' REAL")
 
+    if "district_code" not in columns:
+        cursor.execute("ALTER TABLE listings ADD COLUMN district_code TEXT")
+
     # Select all rows with original columns
     cursor.execute("""
-        SELECT url, size, `Bruttó méret`, rooms, price_huf, price_eur, Belmagasság
+        SELECT url, location, size, `Bruttó méret`, rooms, price_huf, price_eur, Belmagasság
         FROM listings
     """)
     rows = cursor.fetchall()
 
-    # Normalize and update
+    # Normalize all rows first, then write them back in one batched transaction
+    updates = []
     for row in rows:
-        url, raw_size, raw_gross_size, raw_rooms, raw_price_huf, raw_price_eur, raw_height = row
+        url, location, raw_size, raw_gross_size, raw_rooms, raw_price_huf, raw_price_eur, raw_height = row
 
         size_val = to_number(raw_size)
         gross_size_val = to_number(raw_gross_size)
-        room_val = int(to_number(raw_rooms)) if to_number(raw_rooms) is not None else None
+        rooms_num = to_number(raw_rooms)
+        room_val = int(rooms_num) if rooms_num is not None else None
         price_huf_val = parse_price(raw_price_huf)
         price_eur_val = to_number(raw_price_eur.replace("€", "") if raw_price_eur else None)
         height_val = to_number(raw_height)
+        district = district_code(location)
 
-        cursor.execute("""
-            UPDATE listings
-            SET Méret_clean = ?,
-                `Bruttó méret_clean` = ?,
-                rooms_clean = ?,
-                price_huf_clean = ?,
-                price_eur_clean = ?,
-                Belmagasság_clean = ?
-            WHERE url = ?
-        """, (
+        updates.append((
             size_val,
             gross_size_val,
             room_val,
             price_huf_val,
             price_eur_val,
             height_val,
+            district,
             url
         ))
 
+    conn.execute("BEGIN")
+    cursor.executemany("""
+        UPDATE listings
+        SET Méret_clean = ?,
+            `Bruttó méret_clean` = ?,
+            rooms_clean = ?,
+            price_huf_clean = ?,
+            price_eur_clean = ?,
+            Belmagasság_clean = ?,
+            district_code = ?
+        WHERE url = ?
+    """, updates)
+
     conn.commit()
     conn.close()
@@ -1,8 +1,115 @@
-import sqlite3
 from datetime import datetime, timedelta
+import hashlib
 import os
 import json
 
+import db
+
+# Typed search_log column for each filter key (backend and frontend names)
+FILTER_COLUMNS = {
+    "jelleg": "type", "type": "type",
+    "elhelyezkedes": "location", "location": "location",
+    "ar_min": "min_price", "min_price": "min_price",
+    "ar_max": "max_price", "max_price": "max_price",
+    "meret_min": "min_size", "min_size": "min_size",
+    "meret_max": "max_size", "max_size": "max_size",
+    "szoba_min": "min_rooms", "min_rooms": "min_rooms",
+    "szoba_max": "max_rooms", "max_rooms": "max_rooms",
+}
+CATEGORICAL_COLUMNS = ["type", "location"]
+RANGE_COLUMNS = ["min_price", "max_price", "min_size", "max_size", "min_rooms", "max_rooms"]
+
+# Databases whose search_log schema has been checked by this process
+_ready_dbs = set()
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def filter_columns(filters):
+    """Map a filters dict onto the typed search_log columns (missing/empty values are None)"""
+    columns = dict.fromkeys(CATEGORICAL_COLUMNS + RANGE_COLUMNS)
+    for key, value in filters.items():
+        column = FILTER_COLUMNS.get(key)
+        if column is None or not value:
+            continue
+        columns[column] = _to_float(value) if column in RANGE_COLUMNS else str(value)
+    return columns
+
+
+def _digest(filters):
+    """Fixed-size key of a filters dict, independent of key order"""
+    return hashlib.blake2b(repr(tuple(sorted(filters.items()))).encode(), digest_size=16).digest()
+
+
+def ensure_schema(conn):
+    """Create search_log, adding and backfilling the typed filter and hash columns on older databases"""
+    # One transaction, so a failed backfill leaves no added-but-empty columns behind
+    conn.execute("BEGIN")
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS search_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filters TEXT NOT NULL,
+                searched_at TEXT NOT NULL
+            );
+        """)
+
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(search_log)")}
+        missing = [c for c in CATEGORICAL_COLUMNS + RANGE_COLUMNS + ["filters_hash"] if c not in existing]
+        for column in missing:
+            column_type = "REAL" if column in RANGE_COLUMNS else "BLOB" if column == "filters_hash" else "TEXT"
+            conn.execute(f"ALTER TABLE search_log ADD COLUMN {column} {column_type}")
+
+        # Backfill rows logged before the typed/hash columns existed (log_scrape always sets the hash).
+        # Rows whose filters can't be parsed are deleted: left NULL they would match every search.
+        assignments = ", ".join(f"{c} = :{c}" for c in CATEGORICAL_COLUMNS + RANGE_COLUMNS + ["filters_hash"])
+        updates, unparsable = [], []
+        pending = conn.execute("SELECT id, filters FROM search_log WHERE filters_hash IS NULL").fetchall()
+        for row_id, filters_str in pending:
+            try:
+                filters = json.loads(filters_str)
+                columns = filter_columns(filters)
+            except (json.JSONDecodeError, TypeError, AttributeError):
+                unparsable.append((row_id,))
+                continue
+            columns["filters_hash"] = _digest(filters)
+            columns["id"] = row_id
+            updates.append(columns)
+        conn.executemany("DELETE FROM search_log WHERE id = ?", unparsable)
+
+        if updates:
+            # Backfilled hashes may repeat ones already logged; the unique index is rebuilt below
+            conn.execute("DROP INDEX IF EXISTS ux_filters_hash;")
+            conn.executemany(f"UPDATE search_log SET {assignments} WHERE id = :id", updates)
+
+            # Older logs repeat identical searches; keep only the latest row of each
+            conn.execute("""
+                DELETE FROM search_log
+                WHERE id NOT IN (SELECT MAX(id) FROM search_log GROUP BY filters_hash)
+            """)
+
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_searched_at ON search_log(searched_at);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_type_location_searched_at ON search_log(type, location, searched_at);")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_filters_hash ON search_log(filters_hash);")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _get_connection(db_path):
+    conn = db.get_connection(db_path)
+    if db_path not in _ready_dbs:
+        with db.write_lock:
+            ensure_schema(conn)
+        _ready_dbs.add(db_path)
+    return conn
+
 
 def log_scrape(db_path="search_log.db", filters=None):
     """
@@ -17,95 +124,43 @@ def log_scrape(db_path="search_log.db", filters=None):
     # Ensure filters is a dict (or fallback to empty)
     filters = filters or {}
 
-    # Serialize filters as sorted JSON to ensure consistent comparisons
-    filters_str = json.dumps(filters, sort_keys=True, separators=(',', ':'))
+    # Shared connection (the database file and table are created if they don't exist)
+    conn = _get_connection(db_path)
 
-    # Connect to database (will create if not exists)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    # Store the filters as JSON (returned to callers), as typed columns for SQL-side
+    # matching and as a digest for exact lookups
+    columns = filter_columns(filters)
+    columns["filters"] = json.dumps(filters, sort_keys=True, separators=(',', ':'))
+    columns["filters_hash"] = _digest(filters)
+    columns["searched_at"] = datetime.now().isoformat()
 
-    # Create the search_log table if it doesn't exist
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS search_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filters TEXT NOT NULL,
-            searched_at TEXT NOT NULL
-        );
-    """)
-
-    # Insert the log entry
-    cursor.execute("""
-        INSERT INTO search_log (filters, searched_at)
-        VALUES (?, ?);
-    """, (filters_str, datetime.now().isoformat()))
-
-    conn.commit()
-    conn.close()
+    # Repeating a logged search only refreshes its timestamp
+    with db.write_lock:
+        conn.execute(f"""
+            INSERT INTO search_log ({", ".join(columns)})
+            VALUES ({", ".join(f":{c}" for c in columns)})
+            ON CONFLICT(filters_hash) DO UPDATE SET searched_at = excluded.searched_at;
+        """, columns)
 
 
 def isInLog(db_path="search_log.db", filters=None):
     if filters is None:
         return False
 
-    filters_str = json.dumps(filters, sort_keys=True, separators=(',', ':'))
-
-    conn = sqlite3.connect(db_path)
+    conn = _get_connection(db_path)
     cursor = conn.cursor()
 
     cursor.execute("""
         SELECT 1 FROM search_log
-        WHERE filters = ?
+        WHERE filters_hash = ?
         LIMIT 1;
-    """, (filters_str,))
+    """, (_digest(filters),))
 
     result = cursor.fetchone()
-    conn.close()
 
     return result is not None
 
 
-def is_subset_search(current_filters, existing_filters):
-    """
-    Check if current search is a subset of an existing search.
-    Returns True if current search can be satisfied by filtering existing results.
-    """
-    if not existing_filters:
-        return False
-    
-    # Compare each filter parameter
-    for key, current_value in current_filters.items():
-        if key == "sort" or not current_value:
-            continue
-            
-        existing_value = existing_filters.get(key)
-        if not existing_value:
-            # If existing search doesn't have this filter, it's broader (good)
-            continue
-            
-        # Convert to appropriate types for comparison
-        if key in ["min_price", "max_price", "min_size", "max_size", "min_rooms", "max_rooms"]:
-            try:
-                current_num = float(current_value)
-                existing_num = float(existing_value)
-                
-                if key.startswith("min_"):
-                    # Current min should be >= existing min (more restrictive is ok)
-                    if current_num < existing_num:
-                        return False
-                elif key.startswith("max_"):
-                    # Current max should be <= existing max (more restrictive is ok)
-                    if current_num > existing_num:
-                        return False
-            except (ValueError, TypeError):
-                continue
-        else:
-            # For categorical filters (type, location), must match exactly
-            if current_value != existing_value:
-                return False
-    
-    return True
-
-
 def find_recent_compatible_search(db_path="search_log.db", filters=None, hours_limit=24):
     """
     Find a recent search that could satisfy the current search requirements.
@@ -114,36 +169,33 @@ def find_recent_compatible_search(db_path="search_log.db", filters=None, hours_l
     if filters is None:
         return None
     
-    # Remove sort parameter for comparison
-    search_filters = {k: v for k, v in filters.items() if k != "sort" and v}
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    conn = _get_connection(db_path)
     
     # Get recent searches within the time limit
     cutoff_time = (datetime.now() - timedelta(hours=hours_limit)).isoformat()
     
-    cursor.execute("""
-        SELECT filters, searched_at FROM search_log
-        WHERE searched_at > ?
-        ORDER BY searched_at DESC
-    """, (cutoff_time,))
+    # A logged search is compatible if every filter it used is equal to (categorical)
+    # or no more restrictive than (ranges) the current one; NULL means "not filtered"
+    params = filter_columns(filters)
+    params["cutoff_time"] = cutoff_time
     
-    recent_searches = cursor.fetchall()
-    conn.close()
-    
-    for filters_str, searched_at in recent_searches:
-        try:
-            existing_filters = json.loads(filters_str)
-            # Remove sort and None values for comparison
-            existing_search_filters = {k: v for k, v in existing_filters.items() if k != "sort" and v}
-            
-            if is_subset_search(search_filters, existing_search_filters):
-                return existing_filters
-        except (json.JSONDecodeError, TypeError):
-            continue
+    cursor = conn.execute("""
+        SELECT filters FROM search_log
+        WHERE searched_at > :cutoff_time
+            AND (type IS NULL OR type = :type)
+            AND (location IS NULL OR location = :location)
+            AND (min_price IS NULL OR min_price <= :min_price)
+            AND (max_price IS NULL OR max_price >= :max_price)
+            AND (min_size IS NULL OR min_size <= :min_size)
+            AND (max_size IS NULL OR max_size >= :max_size)
+            AND (min_rooms IS NULL OR min_rooms <= :min_rooms)
+            AND (max_rooms IS NULL OR max_rooms >= :max_rooms)
+        ORDER BY searched_at DESC
+        LIMIT 1
+    """, params)
     
-    return None
+    row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
 
 
 def should_scrape(db_path="search_log.db", filters=None, hours_limit=24):
@@ -1,67 +1,196 @@
-import requests
-from bs4 import BeautifulSoup
-import time
+import asyncio
+import hashlib
+import httpx
+import lxml.html
+import re
+from lxml import etree
+from lxml.cssselect import CSSSelector
 import sqlite3
+import time
+from functools import lru_cache
+import db
 import link_generator
 import scrape_logger
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
-from datetime import datetime, timedelta
+from itertools import islice
 
 BASE_URL = "https://www.oc.hu"
 LIST_URL = f"{BASE_URL}/ingatlanok/lista/jelleg:lakas;ertekesites:elado;elhelyezkedes:budapest08"
 HEADERS = {"User-Agent": "Mozilla/5.0"}
 
-# Thread-local storage for sessions
-thread_local = threading.local()
-
-# Global cache for responses (thread-safe with simple dict + lock)
-response_cache = {}
-cache_lock = threading.Lock()
+# Response cache, persisted across runs in its own SQLite database
+RESPONSE_CACHE_DB = "response_cache.db"
 CACHE_DURATION_HOURS = 2
+PROJECT_CACHE_DURATION_HOURS = 0.5  # Project pages change as their apartments sell
+# Bumped when older cache contents must not be served. Version 1 drops the
+# error pages cached before fetch rejected non-2xx responses.
+RESPONSE_CACHE_VERSION = 1
+_response_cache_ready = False
 
-def get_session():
-    """Get or create a thread-local session with optimized settings"""
-    if not hasattr(thread_local, 'session'):
-        thread_local.session = requests.Session()
-        thread_local.session.headers.update(HEADERS)
-        # Connection pooling settings
-        adapter = requests.adapters.HTTPAdapter(
-            pool_connections=5,   # Fewer per thread since we have multiple threads
-            pool_maxsize=10,      # Maximum connections in pool per thread
-            max_retries=3         # Retry failed requests
-        )
-        thread_local.session.mount('http://', adapter)
-        thread_local.session.mount('https://', adapter)
-    return thread_local.session
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+def _info_row(n):
+    # div.info-row:nth-of-type(n)
+    return f"div[{_has_class('info-row')}][count(preceding-sibling::div) = {n - 1}]"
+
+# Listing card fields and their relative XPaths, evaluated against each card
+_CARD_FIELD_NAMES = ("location", "size", "rooms", "price_huf", "price_eur", "description")
+_CARD_FIELD_PATHS = tuple(etree.XPath(path) for path in (
+    f".//{_info_row(2)}//*[{_has_class('text-left')}]",
+    f".//{_info_row(2)}//*[{_has_class('text-end')}]",
+    f".//{_info_row(3)}//*[{_has_class('text-end')}]",
+    f".//*[{_has_class('price-huf')}]",
+    f".//*[{_has_class('price-eur')}]",
+    f".//*[{_has_class('description')}]//p",
+))
+
+# Precompiled selectors for the rest of the list and detail pages
+_RESULT_COUNT = CSSSelector(".py-2")
+_LISTING_CARDS = CSSSelector("a[data-action='seo#selectItem']")
+_DETAIL_LABELS = CSSSelector("div.row.row-cols-2 .data-label")
+_DETAIL_VALUES = CSSSelector("div.row.row-cols-2 .data-value")
+_HEAD_ADDRESS = CSSSelector(".head-address")
+# Apartment links: /ingatlanok/ hrefs containing a digit (translate() strips digits)
+_APARTMENT_HREFS = etree.XPath(
+    "//a[contains(@href, '/ingatlanok/') and translate(@href, '0123456789', '') != @href]/@href",
+    smart_strings=False,
+)
+
+# Numeric parts of the card price / size strings, used by the pre-filter
+_PRICE_RE = re.compile(r'[\d,.\s]+')
+_SIZE_RE = re.compile(r'(\d+)')
+
+# Rows per executemany call in batch_upsert_listings
+UPSERT_BATCH_SIZE = 10000
+
+# Upserts of more than max(MIN_ROWS, RATIO * existing rows) drop the secondary
+# indexes and rebuild them afterwards instead of updating them row by row
+INDEX_REBUILD_MIN_ROWS = 1000
+INDEX_REBUILD_RATIO = 0.1
+
+# URLs per IN (...) lookup of existing listings (below SQLite's bound-parameter limit)
+LOOKUP_BATCH_SIZE = 500
+
+# Pages are fetched on one event loop over a single shared HTTP/2 client - its
+# few connections multiplex many requests; semaphores cap the in-flight requests of each phase
+MAX_CONNECTIONS = 8
+REQUEST_TIMEOUT = 20  # seconds
+CONNECT_RETRIES = 3  # Retries of failed connection attempts, as the old requests HTTPAdapter did
+LIST_PAGE_CONCURRENCY = 8  # Paces the list-page burst instead of sleeping
+DETAIL_CONCURRENCY = 32
+REQUESTS_PER_SECOND = 20  # Aggregate request rate to oc.hu, across all in-flight requests
+
+def first_text(selector, element):
+    """Stripped text of the first element matched by selector (CSSSelector or XPath), or None"""
+    matches = selector(element)
+    return matches[0].text_content().strip() if matches else None
+
+def create_client_session():
+    """HTTP/2 client shared by every request of a scrape, retrying failed connects"""
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=CONNECT_RETRIES, limits=limits)
+    return httpx.AsyncClient(transport=transport, headers=HEADERS, timeout=REQUEST_TIMEOUT,
+                             follow_redirects=True)
+
+class RateLimiter:
+    """
+    Token bucket: up to `rate` acquisitions per second, with bursts of at most
+    `capacity`. Uses no loop-bound primitives, so one instance serves every
+    asyncio.run; acquire() has no await between the check and the take, which
+    makes it safe for concurrent coroutines on one event loop.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+
+async def fetch(session, url, sem):
+    """
+    GET url and return the response body, holding a semaphore slot while in flight.
+    Raises httpx.HTTPStatusError for non-2xx responses.
+    """
+    async with sem:
+        await _rate_limiter.acquire()
+        res = await session.get(url)
+        res.raise_for_status()
+        return res.text
+
+def get_cache_connection():
+    """Shared response cache connection, creating the table on first use"""
+    global _response_cache_ready
+    conn = db.get_connection(RESPONSE_CACHE_DB)
+    if not _response_cache_ready:
+        with db.write_lock:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    url_hash BLOB PRIMARY KEY,
+                    body TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID;
+            """)
+            # Lets clear_expired_cache delete the expired range without scanning the table
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache(expires_at);")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < RESPONSE_CACHE_VERSION:
+                conn.execute("DELETE FROM response_cache")
+                conn.execute(f"PRAGMA user_version = {RESPONSE_CACHE_VERSION}")
+        _response_cache_ready = True
+    return conn
+
+def clear_expired_cache():
+    """Remove expired entries from cache (reads already skip them)"""
+    conn = get_cache_connection()
+    with db.write_lock:
+        deleted = conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+    if deleted:
+        print(f"[CACHE] Cleaned up {deleted} expired entries")
+
+def cache_key(url):
+    return hashlib.sha1(url.encode()).digest()
 
 def get_cached_response(url):
     """Get cached response if available and not expired"""
-    with cache_lock:
-        if url in response_cache:
-            cached_data, timestamp = response_cache[url]
-            if datetime.now() - timestamp < timedelta(hours=CACHE_DURATION_HOURS):
-                return cached_data
-            else:
-                # Remove expired cache entry
-                del response_cache[url]
-    return None
+    row = get_cache_connection().execute(
+        "SELECT body FROM response_cache WHERE url_hash = ? AND expires_at > ?",
+        (cache_key(url), time.time())
+    ).fetchone()
+    return row[0] if row else None
 
-def cache_response(url, response_text):
-    """Cache response with timestamp"""
-    with cache_lock:
-        response_cache[url] = (response_text, datetime.now())
+def cache_response(url, response_text, hours=CACHE_DURATION_HOURS):
+    """
+    Cache response for the given number of hours. Only pass bodies returned by
+    fetch, which raises for non-2xx responses, so error pages are never cached.
+    """
+    conn = get_cache_connection()
+    with db.write_lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (url_hash, body, expires_at) VALUES (?, ?, ?)",
+            (cache_key(url), response_text, time.time() + hours * 3600)
+        )
 
-def clear_expired_cache():
-    """Remove expired entries from cache"""
-    cutoff_time = datetime.now() - timedelta(hours=CACHE_DURATION_HOURS)
-    with cache_lock:
-        expired_urls = [url for url, (_, timestamp) in response_cache.items() 
-                       if timestamp < cutoff_time]
-        for url in expired_urls:
-            del response_cache[url]
-        if expired_urls:
-            print(f"[CACHE] Cleaned up {len(expired_urls)} expired entries")
+def get_existing_listings(conn, urls):
+    """(price_huf, size) of the already stored listings among urls, keyed by url"""
+    urls = list(urls)
+    existing_listings = {}
+    for start in range(0, len(urls), LOOKUP_BATCH_SIZE):
+        batch = urls[start:start + LOOKUP_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        rows = conn.execute(f"SELECT url, price_huf, size FROM listings WHERE url IN ({placeholders})", batch)
+        existing_listings.update((url, (price, size)) for url, price, size in rows)
+    return existing_listings
 
 def listing_needs_update(listing_data, existing_listings):
     """Check if a listing needs to be updated based on basic data changes"""
@@ -98,8 +227,7 @@ def should_process_listing(listing_data, filters):
                     price_num = float(price_str.replace("M", "").replace(" ", "").replace(",", ".")) * 1000000
                 else:
                     # Try to extract number from string
-                    import re
-                    price_match = re.search(r'[\d,.\s]+', price_str.replace(" ", ""))
+                    price_match = _PRICE_RE.search(price_str.replace(" ", ""))
                     if price_match:
                         price_num = float(price_match.group().replace(",", ".").replace(" ", ""))
                     else:
@@ -116,8 +244,7 @@ def should_process_listing(listing_data, filters):
         # Basic size filtering
         if filters.get("meret_min") or filters.get("meret_max"):
             try:
-                import re
-                size_match = re.search(r'(\d+)', size_str)
+                size_match = _SIZE_RE.search(size_str)
                 if size_match:
                     size_num = float(size_match.group())
                     if filters.get("meret_min") and size_num < float(filters["meret_min"]):
@@ -131,38 +258,38 @@ def should_process_listing(listing_data, filters):
     except Exception:
         return True  # Process if any error in pre-filtering
 
-def process_listing_details(listing_data, delay=0.1):
+async def process_listing_details(listing_data, session, sem):
     """Process a single listing's details - designed for concurrent execution"""
     try:
-        session = get_session()
-        
-        # Add small delay to be respectful
-        time.sleep(delay)
-        
         # Merge in detailed fields
-        details = get_listing_details(listing_data["url"], session)
+        details = await get_listing_details(listing_data["url"], session, sem)
+        
+        # Normalize to all keys (missing ones will be None); detail fields win.
+        # Builds a new dict - neither listing_data nor the shared details are modified
+        normalized = {key: details[key] if key in details else listing_data.get(key) for key in keys}
         
         # Standard single listing processing
-        if not details.get('Jelleg'):
+        if not normalized['Jelleg']:
             if listing_data["jelleg"] == "lakas":
-                details['Jelleg'] = "lakás"
+                normalized['Jelleg'] = "lakás"
             elif listing_data["jelleg"] == "haz":
-                details['Jelleg'] = "ház"
+                normalized['Jelleg'] = "ház"
             else:
-                details['Jelleg'] = "telek"
+                normalized['Jelleg'] = "telek"
         
-        # Remove temporary jelleg field
-        listing_data.pop("jelleg", None)
-        listing_data.update(details)
-
-        # Normalize to all keys (missing ones will be None)
-        normalized = {key: listing_data.get(key, None) for key in keys}
         return normalized
         
     except Exception as e:
         print(f"Error processing listing {listing_data.get('url', 'unknown')}: {e}")
         return None
 
+async def process_all_listing_details(session, listings):
+    """Fetch and merge the details of every listing concurrently on one event loop"""
+    sem = asyncio.Semaphore(DETAIL_CONCURRENCY)
+    return await asyncio.gather(
+        *[process_listing_details(listing_data, session, sem) for listing_data in listings]
+    )
+
 # Keys from the full database schema
 keys = [
     'url', 'location','size', 'rooms', 'price_huf', 'price_eur', 'description',
@@ -176,16 +303,31 @@ keys = [
     'galéria','lokáció','Ár-Érték Index'
 ]
 
+# Listing write statements, built once from keys
+_COLUMNS_ESCAPED = ", ".join([f'"{k}"' for k in keys])
+_PLACEHOLDERS = ','.join(['?'] * len(keys))
+_UPDATE_CLAUSES = ", ".join([f'"{k}" = excluded."{k}"' for k in keys if k != 'url'])
+INSERT_SQL = f"INSERT INTO listings ({_COLUMNS_ESCAPED}) VALUES ({_PLACEHOLDERS})"
+# Updates existing urls in place (INSERT OR REPLACE would delete and re-insert them)
+UPSERT_SQL = f"{INSERT_SQL} ON CONFLICT(url) DO UPDATE SET {_UPDATE_CLAUSES}"
+
 def create_table(conn):
     columns = ", ".join([f'"{key}" TEXT' for key in keys])
     conn.execute(f"CREATE TABLE IF NOT EXISTS listings ({columns});")
+
+    # url is the upsert conflict target. Older databases may hold duplicate urls
+    # (INSERT OR REPLACE had no unique key to replace on) - keep the latest row
+    has_url_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_listings_url'"
+    ).fetchone()
+    if not has_url_index:
+        conn.execute("DELETE FROM listings WHERE rowid NOT IN (SELECT MAX(rowid) FROM listings GROUP BY url)")
+        conn.execute("CREATE UNIQUE INDEX ux_listings_url ON listings(url)")
     conn.commit()
 
 def insert_listing(conn, listing_data):
     values = [listing_data.get(key, None) for key in keys]
-    placeholders = ','.join(['?'] * len(keys))
-    columns_escaped = ", ".join([f'"{k}"' for k in keys])
-    conn.execute(f"INSERT INTO listings ({columns_escaped}) VALUES ({placeholders})", values)
+    conn.execute(INSERT_SQL, values)
     # Note: Commit removed - will be done in batch
 
 def batch_upsert_listings(conn, all_listings):
@@ -193,44 +335,53 @@ def batch_upsert_listings(conn, all_listings):
     if not all_listings:
         return
     
-    placeholders = ','.join(['?'] * len(keys))
-    columns_escaped = ", ".join([f'"{k}"' for k in keys])
-    update_clauses = ", ".join([f'"{k}" = excluded."{k}"' for k in keys if k != 'url'])
+    # Rows are built lazily and written in bounded chunks within one transaction
+    all_values = ([listing_data.get(key, None) for key in keys] for listing_data in all_listings)
     
-    all_values = []
-    for listing_data in all_listings:
-        values = [listing_data.get(key, None) for key in keys]
-        all_values.append(values)
+    conn.execute("BEGIN")
     
-    # Use INSERT OR REPLACE for SQLite upsert functionality
-    conn.executemany(f"""
-        INSERT OR REPLACE INTO listings ({columns_escaped}) 
-        VALUES ({placeholders})
-    """, all_values)
+    # Bulk loads rebuild the secondary indexes once at the end;
+    # ux_listings_url is the conflict target and must stay
+    existing_count = conn.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+    dropped_indexes = []
+    if len(all_listings) > max(INDEX_REBUILD_MIN_ROWS, INDEX_REBUILD_RATIO * existing_count):
+        dropped_indexes = conn.execute("""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = 'listings' AND sql IS NOT NULL AND name != 'ux_listings_url'
+        """).fetchall()
+        for name, _ in dropped_indexes:
+            conn.execute(f'DROP INDEX "{name}"')
+    
+    while chunk := list(islice(all_values, UPSERT_BATCH_SIZE)):
+        conn.executemany(UPSERT_SQL, chunk)
+    
+    for _, index_sql in dropped_indexes:
+        conn.execute(index_sql)
     conn.commit()
+    if dropped_indexes:
+        print(f"[BATCH] Rebuilt {len(dropped_indexes)} indexes after bulk load")
     print(f"[BATCH] Upserted {len(all_listings)} listings in single transaction")
 
-def get_individual_apartments_from_project(project_url, session=None):
+# Parsers are memoized on the page body: a page seen twice in a run (a url on several
+# cards, or a cached response) is parsed once. Bodies are the keys, so keep the caches small.
+@lru_cache(maxsize=128)
+def parse_project_apartments(html):
+    """Individual apartment URLs linked from a new construction project page (as a tuple)"""
+    tree = lxml.html.fromstring(html)
+    
+    # Links to individual apartments, deduplicated in discovery order
+    individual_urls = (f"{BASE_URL}{href}" if href.startswith('/') else href for href in _APARTMENT_HREFS(tree))
+    return tuple(dict.fromkeys(individual_urls))
+
+async def get_individual_apartments_from_project(project_url, session, sem):
     """Extract individual apartment URLs from a new construction project page"""
     try:
-        if session is None:
-            session = get_session()
-        
-        response = session.get(project_url)
-        soup = BeautifulSoup(response.text, "html.parser")
-        
-        # Find links to individual apartments
-        apartment_links = soup.find_all('a', href=True)
-        individual_urls = []
-        
-        for link in apartment_links:
-            href = link.get('href')
-            if href and '/ingatlanok/' in href and any(char.isdigit() for char in href):
-                full_url = f"{BASE_URL}{href}" if href.startswith('/') else href
-                individual_urls.append(full_url)
-        
-        # Remove duplicates
-        individual_urls = list(set(individual_urls))
+        response_text = get_cached_response(project_url)
+        if response_text is None:
+            response_text = await fetch(session, project_url, sem)
+            cache_response(project_url, response_text, hours=PROJECT_CACHE_DURATION_HOURS)
+        loop = asyncio.get_running_loop()
+        individual_urls = list(await loop.run_in_executor(None, parse_project_apartments, response_text))
         print(f"[PROJECT] Found {len(individual_urls)} individual apartments in project {project_url}")
         return individual_urls
         
@@ -238,7 +389,19 @@ def get_individual_apartments_from_project(project_url, session=None):
         print(f"Failed to extract apartments from project {project_url}: {e}")
         return []
 
-def get_listing_details(url, session=None):
+@lru_cache(maxsize=256)
+def parse_listing_details(html):
+    """Detail fields of a listing page, keyed by their Hungarian labels (shared - do not modify)"""
+    tree = lxml.html.fromstring(html)
+    data_labels = _DETAIL_LABELS(tree)
+    data_values = _DETAIL_VALUES(tree)
+    details = {label.text_content().strip(): value.text_content().strip()
+               for label, value in zip(data_labels, data_values)}
+    lokacio_elem = _HEAD_ADDRESS(tree)
+    details["lokáció"] = "".join(t.strip() for t in lokacio_elem[0].itertext()) if lokacio_elem else None
+    return details
+
+async def get_listing_details(url, session, sem):
     try:
         # For project pages, treat them as single listings with summary data
         if '/uj-lakas/' in url:
@@ -257,101 +420,71 @@ def get_listing_details(url, session=None):
             response_text = cached_response
         else:
             # Fetch from server
-            if session is None:
-                session = get_session()
-            res = session.get(url)
-            response_text = res.text
+            response_text = await fetch(session, url, sem)
             # Cache the response
             cache_response(url, response_text)
         
-        # Parse the response (cached or fresh)
-        detail_soup = BeautifulSoup(response_text, "html.parser")
-        data_labels = detail_soup.select("div.row.row-cols-2 .data-label")
-        data_values = detail_soup.select("div.row.row-cols-2 .data-value")
-        details = {label.text.strip(): value.text.strip() for label, value in zip(data_labels, data_values)}
-        lokacio_elem = detail_soup.select_one(".head-address")
-        details["lokáció"] = lokacio_elem.get_text(strip=True) if lokacio_elem else None
-        return details
+        # Parse the response (cached or fresh) off the event loop - parsing is CPU-bound
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, parse_listing_details, response_text)
     except Exception as e:
         print(f"Failed to get details from {url}: {e}")
         return {}
 
-def main(jelleg="lakas",
-    ar_min=None,
-    ar_max=None,
-    elhelyezkedes=None,
-    meret_min=None,
-    meret_max=None,
-    szoba_min=None,
-    szoba_max=None):
-    conn = sqlite3.connect("real_estate_listings.db")
-    create_table(conn)
-    
-    # Smart update: Check existing listings instead of clearing everything
-    cursor = conn.cursor()
-    cursor.execute("SELECT url, price_huf, size FROM listings")
-    existing_listings = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
-    
-    print(f"[SMART UPDATE] Found {len(existing_listings)} existing listings in database")
-    
-    # Get optimized session for all requests
-    session = get_session()
-    
-    # Clean up expired cache entries
-    clear_expired_cache()
+def parse_listing_cards(html, jelleg):
+    """Basic listing info from every listing card of a list page"""
+    tree = lxml.html.fromstring(html)
+    listings = []
+    for listing in _LISTING_CARDS(tree):
+        try:
+            url_suffix = listing.get("href")
+            full_url = f"{BASE_URL}{url_suffix}"
+
+            fields = zip(_CARD_FIELD_NAMES, (first_text(path, listing) for path in _CARD_FIELD_PATHS))
+            listing_data = {
+                "url": full_url,
+                **dict(fields),
+                "jelleg": jelleg  # Store for later detail fetching
+            }
+            
+            listings.append(listing_data)
+            
+        except Exception as e:
+            print("Skipping listing due to error:", e)
+    return listings
+
+async def collect_listings(session, search_url, jelleg):
+    """Fetch every list page of a search concurrently and collect their listing cards"""
+    sem = asyncio.Semaphore(LIST_PAGE_CONCURRENCY)
+    loop = asyncio.get_running_loop()
     
-    res1 = session.get(
-        link_generator.generate_oc_link(jelleg, "elado", ar_min, ar_max, elhelyezkedes, meret_min, meret_max, szoba_min,
-                                        szoba_max) + f"?page=1")
-    soup1 = BeautifulSoup(res1.text, "html.parser")
-    number_of_pages = int(int(((soup1.select_one(".py-2").get_text()).strip().split())[0])/12)+1
+    # Page 1 gives the result count (12 listings per page)
+    first_page = await fetch(session, f"{search_url}?page=1", sem)
+    tree1 = lxml.html.fromstring(first_page)
+    number_of_pages = int(int((first_text(_RESULT_COUNT, tree1).split())[0])/12)+1
+    print(f"[COLLECT] Scraping {number_of_pages} pages")
     
-    # Collect all listings before processing for batch operations
-    all_listings_to_process = []
+    # Only page 1 is required; a failed later page (429/5xx, or the empty trailing
+    # page the count rounding can ask for) is logged and skipped
+    other_pages = await asyncio.gather(
+        *[fetch(session, f"{search_url}?page={i}", sem) for i in range(2, number_of_pages + 1)],
+        return_exceptions=True
+    )
     
-    # First pass: Collect all basic listing info
-    for i in range(1,number_of_pages+1):
-        print(f"[COLLECT] Scraping page {i}/{number_of_pages}")
-        res = session.get(link_generator.generate_oc_link(jelleg,"elado",ar_min, ar_max, elhelyezkedes,meret_min, meret_max, szoba_min,szoba_max) + f"?page={i}")
-        soup = BeautifulSoup(res.text, "html.parser")
+    all_listings = []
+    for page_number, html in enumerate([first_page, *other_pages], start=1):
+        if isinstance(html, Exception):
+            print(f"Failed to fetch list page {page_number}: {html}")
+            continue
+        all_listings.extend(await loop.run_in_executor(None, parse_listing_cards, html, jelleg))
+    return all_listings
 
-        for listing in soup.select("a[data-action='seo#selectItem']"):
-            try:
-                url_suffix = listing.get("href")
-                full_url = f"{BASE_URL}{url_suffix}"
-
-                location = listing.select_one(".info-row:nth-of-type(2) .text-left")
-                size = listing.select_one(".info-row:nth-of-type(2) .text-end")
-                rooms = listing.select_one(".info-row:nth-of-type(3) .text-end")
-                price_huf = listing.select_one(".price-huf")
-                price_eur = listing.select_one(".price-eur")
-                description = listing.select_one(".description p")
-
-                listing_data = {
-                    "url": full_url,
-                    "location": location.text.strip() if location else None,
-                    "size": size.text.strip() if size else None,
-                    "rooms": rooms.text.strip() if rooms else None,
-                    "price_huf": price_huf.text.strip() if price_huf else None,
-                    "price_eur": price_eur.text.strip() if price_eur else None,
-                    "description": description.text.strip() if description else None,
-                    "jelleg": jelleg  # Store for later detail fetching
-                }
-                
-                all_listings_to_process.append(listing_data)
-                
-            except Exception as e:
-                print("Skipping listing due to error:", e)
+def select_listings_to_process(conn, all_listings_to_process, filters_dict):
+    """Listings whose details need fetching: new or changed ones that pass the pre-filter"""
+    # Smart update: Look up only the scraped listings instead of loading the whole table
+    existing_listings = get_existing_listings(conn, {listing_data["url"] for listing_data in all_listings_to_process})
     
-    print(f"[COLLECT] Collected {len(all_listings_to_process)} listings for processing")
-    
-    # Apply smart update filtering and selective filtering
-    filters_dict = {
-        "ar_min": ar_min,
-        "ar_max": ar_max, 
-        "meret_min": meret_min,
-        "meret_max": meret_max
-    }
+    print(f"[SMART UPDATE] Found {len(existing_listings)} of them in the database")
     
     # First: Filter for updates needed
     update_needed_listings = []
@@ -377,36 +510,53 @@ def main(jelleg="lakas",
         
     total_skipped = len(all_listings_to_process) - len(filtered_listings)
     print(f"[OPTIMIZATION] Processing {len(filtered_listings)}/{len(all_listings_to_process)} listings ({total_skipped} skipped)")
+    return filtered_listings
+
+async def scrape_listings(conn, search_url, jelleg, filters_dict):
+    """Collect a search's listings and fetch the details of those needing it, over one shared session"""
+    async with create_client_session() as session:
+        # First pass: Collect all basic listing info
+        all_listings_to_process = await collect_listings(session, search_url, jelleg)
+        
+        print(f"[COLLECT] Collected {len(all_listings_to_process)} listings for processing")
+        
+        filtered_listings = select_listings_to_process(conn, all_listings_to_process, filters_dict)
+        
+        # Second pass: Process details concurrently
+        print(f"[CONCURRENT] Processing details with up to {DETAIL_CONCURRENCY} concurrent requests...")
+        
+        results = await process_all_listing_details(session, filtered_listings)
     
-    # Second pass: Process details concurrently
-    processed_listings = []
-    max_workers = 8  # Concurrent threads - adjust based on server tolerance
+    processed_listings = [result for result in results if result]
+    print(f"[CONCURRENT] Completed processing {len(processed_listings)} listings successfully")
+    return processed_listings
+
+def main(jelleg="lakas",
+    ar_min=None,
+    ar_max=None,
+    elhelyezkedes=None,
+    meret_min=None,
+    meret_max=None,
+    szoba_min=None,
+    szoba_max=None):
+    conn = db.configure(sqlite3.connect("real_estate_listings.db"))
+    create_table(conn)
     
-    print(f"[CONCURRENT] Processing details with {max_workers} concurrent workers...")
+    # Clean up expired cache entries
+    clear_expired_cache()
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_listing = {
-            executor.submit(process_listing_details, listing_data.copy()): i 
-            for i, listing_data in enumerate(filtered_listings)
-        }
-        
-        completed = 0
-        for future in as_completed(future_to_listing):
-            listing_index = future_to_listing[future]
-            try:
-                result = future.result()
-                if result:
-                    processed_listings.append(result)
-                completed += 1
-                
-                if completed % 10 == 0:
-                    print(f"[CONCURRENT] Completed {completed}/{len(filtered_listings)} listings")
-                    
-            except Exception as e:
-                print(f"Error in concurrent processing for listing {listing_index}: {e}")
+    search_url = link_generator.generate_oc_link(jelleg, "elado", ar_min, ar_max, elhelyezkedes, meret_min, meret_max,
+                                                 szoba_min, szoba_max)
     
-    print(f"[CONCURRENT] Completed processing {len(processed_listings)} listings successfully")
+    # Apply smart update filtering and selective filtering
+    filters_dict = {
+        "ar_min": ar_min,
+        "ar_max": ar_max, 
+        "meret_min": meret_min,
+        "meret_max": meret_max
+    }
+    
+    processed_listings = asyncio.run(scrape_listings(conn, search_url, jelleg, filters_dict))
     
     # Batch upsert all processed listings
     if processed_listings:
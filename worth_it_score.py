@@ -1,6 +1,20 @@
 import sqlite3
+
+import db
 from market_analysis import MarketAnalyzer
 
+# Rows per executemany call when writing the analysis results
+UPDATE_BATCH_SIZE = 10000
+
+UPDATE_SQL = """
+    UPDATE listings SET 
+        'Ár-Érték Index' = ?,
+        'Piaci Insight' = ?,
+        'Ár/m² Eltérés %' = ?,
+        'Érték Minősítés' = ?
+    WHERE url = ?
+"""
+
 def calculate_score(price, size, rooms):
     """Legacy simple calculation - kept as fallback"""
     try:
@@ -9,7 +23,7 @@ def calculate_score(price, size, rooms):
         return None
 
 def main():
-    conn = sqlite3.connect("real_estate_listings.db")
+    conn = db.configure(sqlite3.connect("real_estate_listings.db"))
     cur = conn.cursor()
 
     # Add new columns if they don't exist
@@ -30,60 +44,47 @@ def main():
     # Initialize market analyzer
     analyzer = MarketAnalyzer()
     
-    # Fetch all records with required fields
-    cur.execute("""
-        SELECT url, lokáció, Jelleg, Állapot, Méret_clean, price_huf_clean, rooms_clean 
-        FROM listings
-    """)
-    rows = cur.fetchall()
+    # Fetch all records with required fields and their segment stats in one pass
+    rows = list(analyzer.get_listings_with_segment_stats())
+    # The table doesn't change while scoring, so one freshness token serves the whole pass
+    listings_version = analyzer.get_listings_version()
 
     print(f"[ANALYSIS] Processing {len(rows)} properties for market analysis...")
     
-    # Update each with enhanced analysis
+    # Analyse each property, then write all results in one transaction
+    updates = []
     for i, row in enumerate(rows):
-        url, lokacio, jelleg, allapot, size, price, rooms = row
+        url, lokacio, jelleg, allapot, size, price, rooms, segment_stats = row
         
         if i % 50 == 0:  # Progress indicator
             print(f"[ANALYSIS] Processed {i}/{len(rows)} properties...")
         
-        # Calculate enhanced worth it score using market analysis
-        enhanced_score = analyzer.calculate_enhanced_worth_it_score(
-            lokacio, jelleg, allapot, size, price, rooms
-        )
-        
-        # Get market insight for additional data
+        # Get market insight once; the score builds on it
         market_insight = analyzer.get_property_market_insight(
-            lokacio, jelleg, allapot, size, price
+            lokacio, jelleg, allapot, size, price, segment_stats, listings_version
         )
         
-        # Prepare update values
-        update_values = {'score': enhanced_score}
-        
         if market_insight:
-            update_values.update({
+            # Calculate enhanced worth it score using market analysis
+            enhanced_score = analyzer.calculate_enhanced_worth_it_score(
+                lokacio, jelleg, allapot, size, price, rooms, segment_stats, insight=market_insight
+            )
+            update_values = {
+                'score': enhanced_score,
                 'insight': f"Piaci átlag: {market_insight['market_avg_price_per_sqm']:,.0f} Ft/m² ({market_insight['market_sample_count']} ingatlan alapján)",
                 'price_diff_pct': market_insight['price_diff_pct'],
                 'value_assessment': market_insight['value_assessment']
-            })
+            }
         else:
             # Fallback for properties without market data
-            simple_score = calculate_score(price, size, rooms)
-            update_values.update({
-                'score': simple_score,
+            update_values = {
+                'score': calculate_score(price, size, rooms),
                 'insight': "Nincs elegendő piaci adat az összehasonlításhoz",
                 'price_diff_pct': None,
                 'value_assessment': "Ismeretlen"
-            })
+            }
         
-        # Update database
-        cur.execute("""
-            UPDATE listings SET 
-                'Ár-Érték Index' = ?,
-                'Piaci Insight' = ?,
-                'Ár/m² Eltérés %' = ?,
-                'Érték Minősítés' = ?
-            WHERE url = ?
-        """, (
+        updates.append((
             update_values['score'],
             update_values['insight'], 
             update_values['price_diff_pct'],
@@ -91,6 +92,10 @@ def main():
             url
         ))
 
+    conn.execute("BEGIN")
+    for start in range(0, len(updates), UPDATE_BATCH_SIZE):
+        cur.executemany(UPDATE_SQL, updates[start:start + UPDATE_BATCH_SIZE])
+
     print(f"[ANALYSIS] Completed market analysis for all properties")
     conn.commit()
     conn.close()